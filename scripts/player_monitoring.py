@@ -56,14 +56,8 @@ def _monitor_players(tags: Sequence[str]) -> int:
         return 1
     with get_connection() as conn:
         cur = conn.cursor()
-        existing, missing = _split_existing_and_missing(cur, normalized)
-        if missing:
-            print("存在しないプレイヤータグ: " + ", ".join(missing), file=sys.stderr)
-        if not existing:
-            print("監視対象に設定できるプレイヤーがありませんでした。")
-            return 1
         now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-        placeholders = ",".join(["%s"] * len(existing))
+        placeholders = ",".join(["%s"] * len(normalized))
         cur.execute(
             f"""
             UPDATE players
@@ -75,9 +69,18 @@ def _monitor_players(tags: Sequence[str]) -> int:
                 END
             WHERE tag IN ({placeholders})
             """,
-            [now, *existing],
+            [now, *normalized],
         )
-        print(f"{cur.rowcount} 件のプレイヤーを監視対象に設定しました。")
+        updated = cur.rowcount
+        # 更新件数が足りない場合だけ、存在しないタグを調べて報告する
+        if updated < len(normalized):
+            existing, missing = _split_existing_and_missing(cur, normalized)
+            if missing:
+                print("存在しないプレイヤータグ: " + ", ".join(missing), file=sys.stderr)
+            if not existing:
+                print("監視対象に設定できるプレイヤーがありませんでした。")
+                return 1
+        print(f"{updated} 件のプレイヤーを監視対象に設定しました。")
     return 0
 
 
@@ -88,13 +91,7 @@ def _unmonitor_players(tags: Sequence[str]) -> int:
         return 1
     with get_connection() as conn:
         cur = conn.cursor()
-        existing, missing = _split_existing_and_missing(cur, normalized)
-        if missing:
-            print("存在しないプレイヤータグ: " + ", ".join(missing), file=sys.stderr)
-        if not existing:
-            print("監視対象から解除できるプレイヤーがありませんでした。")
-            return 1
-        placeholders = ",".join(["%s"] * len(existing))
+        placeholders = ",".join(["%s"] * len(normalized))
         cur.execute(
             f"""
             UPDATE players
@@ -103,9 +100,17 @@ def _unmonitor_players(tags: Sequence[str]) -> int:
                 monitoring_started_at = NULL
             WHERE tag IN ({placeholders})
             """,
-            list(existing),
+            list(normalized),
         )
-        print(f"{cur.rowcount} 件のプレイヤーを監視対象から解除しました。")
+        updated = cur.rowcount
+        if updated < len(normalized):
+            existing, missing = _split_existing_and_missing(cur, normalized)
+            if missing:
+                print("存在しないプレイヤータグ: " + ", ".join(missing), file=sys.stderr)
+            if not existing:
+                print("監視対象から解除できるプレイヤーがありませんでした。")
+                return 1
+        print(f"{updated} 件のプレイヤーを監視対象から解除しました。")
     return 0
 
 
@@ -0,0 +1,3 @@
+-- current_rank >= ? OR highest_rank >= ? の上位フィルタを index merge で絞り込めるよう、両列に索引を張る
+CREATE INDEX idx_players_current_rank ON players(current_rank);
+CREATE INDEX idx_players_highest_rank ON players(highest_rank);
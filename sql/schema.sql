@@ -73,3 +73,5 @@ CREATE INDEX idx_win_lose_logs_battle_log_id ON win_lose_logs(battle_log_id);
 CREATE INDEX idx_win_player_tag ON win_lose_logs(win_player_tag);
 CREATE INDEX idx_lose_player_tag ON win_lose_logs(lose_player_tag);
 CREATE INDEX idx_players_monitoring_fetch ON players(is_monitored, last_fetched);
+CREATE INDEX idx_players_current_rank ON players(current_rank);
+CREATE INDEX idx_players_highest_rank ON players(highest_rank);
@@ -0,0 +1,41 @@
+"""Beta-Binomial による勝率の下側信頼限界(LCB)を計算する共通処理."""
+
+from __future__ import annotations
+
+from functools import lru_cache
+
+import numpy as np
+from scipy.stats import beta
+
+from .settings import CONFIDENCE_LEVEL
+
+MIN_BETA_SHAPE = 1e-6
+# スカラー版 LCB のメモ化件数の上限
+BETA_LCB_CACHE_SIZE = 1 << 18
+
+
+@lru_cache(maxsize=BETA_LCB_CACHE_SIZE)
+def beta_lcb(alpha: float, beta_param: float, confidence: float = CONFIDENCE_LEVEL) -> float:
+    """Beta分布の下側信頼限界を計算する.
+
+    同じマップ内では事前分布が共通のため、勝敗数が同じ組み合わせは同一の
+    (alpha, beta) になる。結果をメモ化して ``beta.ppf`` の再計算を省く。
+    """
+
+    alpha_safe = max(alpha, MIN_BETA_SHAPE)
+    beta_safe = max(beta_param, MIN_BETA_SHAPE)
+    return float(beta.ppf(1 - confidence, alpha_safe, beta_safe))
+
+
+def beta_lcb_array(
+    alpha: np.ndarray, beta_param: np.ndarray, confidence: float = CONFIDENCE_LEVEL
+) -> np.ndarray:
+    """Beta分布の下側信頼限界を配列単位でまとめて求める.
+
+    ``beta.ppf`` は配列をそのまま受け付けるため、要素ごとに呼び出すよりも
+    SciPy 呼び出しのオーバーヘッドを大きく削減できる。
+    """
+
+    alpha_safe = np.maximum(np.asarray(alpha, dtype=np.float64), MIN_BETA_SHAPE)
+    beta_safe = np.maximum(np.asarray(beta_param, dtype=np.float64), MIN_BETA_SHAPE)
+    return beta.ppf(1 - confidence, alpha_safe, beta_safe)
@@ -1,27 +1,41 @@
 import os
+from functools import lru_cache
 
 import mysql.connector
 from sqlalchemy import create_engine
 
 from .settings import load_environment
 
+# SQLAlchemy のプールで使い回す接続を作り直すまでの秒数
+ENGINE_POOL_RECYCLE_SECONDS = 3600
 
-def get_connection():
+
+@lru_cache(maxsize=1)
+def _connection_params() -> dict[str, str]:
+    """接続設定を読み込む（.env の解析はプロセス内で1回だけ行う）."""
     load_environment()
-    return mysql.connector.connect(
-        host=os.getenv("MYSQL_HOST", "localhost"),
-        user=os.getenv("MYSQL_USER", "root"),
-        password=os.getenv("MYSQL_PASSWORD", ""),
-        database=os.getenv("MYSQL_DB", "brawl_stats"),
-        autocommit=True,
-    )
+    return {
+        "host": os.getenv("MYSQL_HOST", "localhost"),
+        "user": os.getenv("MYSQL_USER", "root"),
+        "password": os.getenv("MYSQL_PASSWORD", ""),
+        "database": os.getenv("MYSQL_DB", "brawl_stats"),
+    }
 
 
+def get_connection():
+    return mysql.connector.connect(**_connection_params(), autocommit=True)
+
+
+@lru_cache(maxsize=1)
 def get_engine():
-    load_environment()
-    user = os.getenv("MYSQL_USER", "root")
-    password = os.getenv("MYSQL_PASSWORD", "")
-    host = os.getenv("MYSQL_HOST", "localhost")
-    database = os.getenv("MYSQL_DB", "brawl_stats")
-    url = f"mysql+mysqlconnector://{user}:{password}@{host}/{database}"
-    return create_engine(url)
+    """プロセス内で共有する Engine を返す（呼び出しごとにプールを作り直さない）."""
+    params = _connection_params()
+    url = (
+        f"mysql+mysqlconnector://{params['user']}:{params['password']}"
+        f"@{params['host']}/{params['database']}"
+    )
+    return create_engine(
+        url,
+        pool_pre_ping=True,
+        pool_recycle=ENGINE_POOL_RECYCLE_SECONDS,
+    )
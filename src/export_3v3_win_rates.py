@@ -3,66 +3,56 @@
 from __future__ import annotations
 
 import argparse
-import json
 import logging
+import multiprocessing
 import shutil
-import math
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import DefaultDict, Dict, Iterable, List, Tuple
 
 import mysql.connector
-from scipy.stats import beta
+import numpy as np
 
+from .beta_stats import beta_lcb_array
 from .db import get_connection
+from .json_utils import write_json
 from .logging_config import setup_logging
 from .stats_loader import StatsDataset, load_recent_ranked_battles
 from .settings import CONFIDENCE_LEVEL, DATA_RETENTION_DAYS
 
 logger = logging.getLogger(__name__)
 JST = timezone(timedelta(hours=9))
-MIN_BETA_SHAPE = 1e-6
 
 MatchupRow = Tuple[int, int, int, int, int, int, int, float]
 
-
-def beta_lcb(alpha: float, beta_param: float, confidence: float = CONFIDENCE_LEVEL) -> float:
-    """Beta分布の下側信頼限界を計算する."""
-
-    alpha_safe = max(alpha, MIN_BETA_SHAPE)
-    beta_safe = max(beta_param, MIN_BETA_SHAPE)
-    return float(beta.ppf(1 - confidence, alpha_safe, beta_safe))
+# 書き出し用ワーカープロセス内で参照する計算結果（_init_export_worker で設定）
+_WORKER_RESULTS: Dict[int, List[Dict[str, object]]] = {}
 
 
 def fetch_matchup_rows(dataset: StatsDataset) -> List[MatchupRow]:
     """3対3の編成ごとの勝敗集計を共通データから生成する."""
 
-    stats: Dict[Tuple[int, Tuple[int, int, int], Tuple[int, int, int]], float] = defaultdict(float)
-    for battle in dataset.iter_ranked_battles():
-        if len(battle.win_brawlers) != 3 or len(battle.lose_brawlers) != 3:
-            continue
-        win_team = tuple(sorted(battle.win_brawlers))
-        lose_team = tuple(sorted(battle.lose_brawlers))
-        stats[(battle.map_id, win_team, lose_team)] += 1.0
-
-    rows: List[MatchupRow] = []
-    for (map_id, win_team, lose_team), wins in stats.items():
-        win_a, win_b, win_c = win_team
-        lose_a, lose_b, lose_c = lose_team
-        rows.append(
-            (
-                int(map_id),
-                int(win_a),
-                int(win_b),
-                int(win_c),
-                int(lose_a),
-                int(lose_b),
-                int(lose_c),
-                float(wins),
-            )
+    map_ids, win_ids, lose_ids = dataset.trio_arrays()
+    if map_ids.size == 0:
+        return []
+
+    # 各陣営のIDを行ごとに昇順に並べ、(map_id, 勝者3人, 敗者3人) の行単位で重複を数える
+    matchups = np.column_stack(
+        (map_ids, np.sort(win_ids, axis=1), np.sort(lose_ids, axis=1))
+    )
+    unique_rows, first_index, counts = np.unique(
+        matchups, axis=0, return_index=True, return_counts=True
+    )
+    # 初出順に並べ直し、従来の辞書集計と同じ行順を保つ
+    order = np.argsort(first_index, kind="stable")
+    return [
+        (map_id, win_a, win_b, win_c, lose_a, lose_b, lose_c, float(wins))
+        for (map_id, win_a, win_b, win_c, lose_a, lose_b, lose_c), wins in zip(
+            unique_rows[order].tolist(), counts[order].tolist()
         )
-    return rows
+    ]
 
 
 def compute_matchup_scores(
@@ -108,43 +98,87 @@ def compute_matchup_scores(
         alpha_prior = mean * strength
         beta_prior = (1 - mean) * strength
 
-        records: List[Tuple[Dict[str, object], float]] = []
-        for win_team, lose_team, wins_val, games in orientation_stats:
-            losses_val = games - wins_val
-            alpha_post = alpha_prior + wins_val
-            beta_post = beta_prior + losses_val
-            lcb = beta_lcb(alpha_post, beta_post, confidence)
-            if not math.isfinite(lcb):
-                continue
-            record = {
-                "win_brawlers": list(win_team),
-                "lose_brawlers": list(lose_team),
-                "games": int(round(games)),
-                "win_rate": wins_val / games if games > 0 else 0.0,
-                "win_rate_lcb": lcb,
-            }
-            records.append(record)
-
-        records.sort(
-            key=lambda item: (item["win_rate_lcb"], item["games"]),
-            reverse=True,
+        # マップ内の全編成分を1回の beta.ppf で計算する
+        count = len(orientation_stats)
+        wins_arr = np.fromiter((item[2] for item in orientation_stats), dtype=np.float64, count=count)
+        games_arr = np.fromiter((item[3] for item in orientation_stats), dtype=np.float64, count=count)
+        lcbs = beta_lcb_array(
+            alpha_prior + wins_arr,
+            beta_prior + (games_arr - wins_arr),
+            confidence=confidence,
         )
+
+        # LCB 降順・試合数降順の並び替えを配列のまま行い、辞書は並び替え後に一度だけ作る
+        kept = np.flatnonzero(np.isfinite(lcbs))
+        games_rounded = np.rint(games_arr[kept])
+        order = kept[np.lexsort((-games_rounded, -lcbs[kept]))].tolist()
+        lcb_list = lcbs.tolist()
+        records: List[Dict[str, object]] = []
+        for idx in order:
+            win_team, lose_team, wins_val, games = orientation_stats[idx]
+            records.append(
+                {
+                    "win_brawlers": list(win_team),
+                    "lose_brawlers": list(lose_team),
+                    "games": int(round(games)),
+                    "win_rate": wins_val / games if games > 0 else 0.0,
+                    "win_rate_lcb": lcb_list[idx],
+                }
+            )
         results[map_id] = records
 
     return results
 
 
-def export_matchup_json(results: Dict[int, List[Dict[str, object]]], output_dir: Path) -> None:
-    """計算結果をマップIDごとのJSONに書き出す."""
+def _init_export_worker(results: Dict[int, List[Dict[str, object]]]) -> None:
+    """書き出し用ワーカープロセスに計算結果を引き渡す."""
+
+    global _WORKER_RESULTS
+    _WORKER_RESULTS = results
+
+
+def _write_map_json(task: Tuple[int, Path]) -> None:
+    map_id, out_file = task
+    write_json(out_file, _WORKER_RESULTS[map_id])
+
+
+def export_matchup_json(
+    results: Dict[int, List[Dict[str, object]]],
+    output_dir: Path,
+    *,
+    max_workers: int = 1,
+) -> None:
+    """計算結果をマップIDごとのJSONに書き出す.
+
+    ``max_workers`` が2以上で fork が使える環境では、マップごとの書き出しを
+    プロセスプールで並列に行う（``results`` はコピーオンライトで共有される）。
+    他スレッドが動いているプロセスからの fork は危険なため、スレッドプール内から
+    呼ぶ場合は既定の1（逐次実行）のまま使うこと。
+    """
 
     if output_dir.exists():
         shutil.rmtree(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    for map_id, records in results.items():
-        out_file = output_dir / f"{map_id}.json"
-        with open(out_file, "w", encoding="utf-8") as fp:
-            json.dump(records, fp, ensure_ascii=False, indent=2)
+    tasks = [(map_id, output_dir / f"{map_id}.json") for map_id in results]
+    workers = min(max_workers, len(tasks))
+    if workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for map_id, out_file in tasks:
+            write_json(out_file, results[map_id])
+        return
+
+    logger.info("%d プロセスでJSONを書き出しています", workers)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_export_worker,
+        initargs=(results,),
+    ) as executor:
+        # 結果を消費して、ワーカー側の例外を呼び出し元へ伝搬させる
+        for _ in executor.map(
+            _write_map_json, tasks, chunksize=max(1, len(tasks) // (4 * workers))
+        ):
+            pass
 
 
 def main() -> None:
@@ -162,6 +196,12 @@ def main() -> None:
         default=4,
         help="統計対象とする最低試合数",
     )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=1,
+        help="JSON 書き出しに使う最大プロセス数（2以上でプロセスプールを使用）",
+    )
     args = parser.parse_args()
 
     since = (datetime.now(JST) - timedelta(days=DATA_RETENTION_DAYS)).strftime("%Y%m%d")
@@ -192,7 +232,7 @@ def main() -> None:
 
     output_dir = Path(args.output_dir)
     logger.info("JSONを出力しています: %s", output_dir)
-    export_matchup_json(results, output_dir)
+    export_matchup_json(results, output_dir, max_workers=args.max_workers)
 
     logger.info("3対3編成統計の出力が完了しました")
 
@@ -1,7 +1,6 @@
 from __future__ import annotations
 
 import argparse
-import json
 import logging
 import shutil
 import time
@@ -32,10 +31,11 @@ from .export_star_rates import compute_star_rates, fetch_star_rows
 from .export_trio_stats import export_trio_json
 from .export_win_rates import compute_win_rates, fetch_stats as fetch_win_rate_rows
 from .export_rank_match_counts import fetch_rank_match_counts
+from .json_utils import write_json
 from .logging_config import setup_logging
-from .settings import CONFIDENCE_LEVEL, DATA_RETENTION_DAYS
+from .settings import CONFIDENCE_LEVEL, DATA_RETENTION_DAYS, STATS_CACHE_DIR
 from .memory_utils import log_memory_usage
-from .stats_loader import load_recent_ranked_battles
+from .stats_loader import load_recent_ranked_battles_cached
 from .trio_stats import compute_trio_scores, fetch_trio_rows
 
 logger = logging.getLogger(__name__)
@@ -44,8 +44,7 @@ JST = timezone(timedelta(hours=9))
 
 def _write_json(path: Path, data) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "w", encoding="utf-8") as fp:
-        json.dump(data, fp, ensure_ascii=False, indent=2)
+    write_json(path, data)
 
 
 def _export_win_rates(dataset, output_path: Path) -> None:
@@ -190,7 +189,7 @@ def main() -> None:
 
     try:
         logger.info("共通データセットを読み込んでいます...")
-        dataset = load_recent_ranked_battles(conn, since)
+        dataset = load_recent_ranked_battles_cached(conn, since, STATS_CACHE_DIR)
         logger.info("ランクマッチ数を取得しています...")
         rank_match_counts = fetch_rank_match_counts(conn)
         monitored_dataset = synchronize_and_fetch_monitored_player_dataset(conn)
@@ -3,24 +3,29 @@ from __future__ import annotations
 """監視対象プレイヤーごとの統計情報を出力するモジュール."""
 
 import argparse
-import json
 import logging
 from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
 from typing import Dict, Iterable, List, Mapping
 
 import mysql.connector
 
 from .db import get_connection
+from .json_utils import write_json
 from .logging_config import setup_logging
 from .postgres_login_history import fetch_login_history_tags
+from .stats_loader import _iter_cursor
 
 logger = logging.getLogger(__name__)
 DEFAULT_VISIBILITY = "none"
 VALID_VISIBILITY = {"public", "private", "none"}
 PRO_RANK_ID = 22
 MIN_PRO_TOTAL_MATCHES = 10
+# バトル情報をカーソルから読み出す際のバッチサイズ
+FETCH_BATCH_SIZE = 50_000
 
 
 @dataclass(frozen=True, slots=True)
@@ -86,6 +91,7 @@ class MonitoredPlayerDataset:
     battles: List[PlayerBattleRecord]
 
 
+@lru_cache(maxsize=8192)
 def _normalize_tag(tag: str) -> str:
     normalized = tag.strip().upper()
     if not normalized:
@@ -388,11 +394,12 @@ def fetch_monitored_player_dataset(conn) -> MonitoredPlayerDataset:
     """
 
     cursor.execute(query)
-    raw_rows = cursor.fetchall()
-    cursor.close()
+    # 全件を一度にリスト化せず、バッチ単位で読み出しながら重複排除する
+    raw_rows = chain.from_iterable(_iter_cursor(cursor, FETCH_BATCH_SIZE))
 
     deduped_battles: Dict[tuple[str, str], PlayerBattleRecord] = {}
     duplicate_count = 0
+    raw_row_count = 0
 
     for (
         player_tag,
@@ -403,6 +410,7 @@ def fetch_monitored_player_dataset(conn) -> MonitoredPlayerDataset:
         brawler_id,
         is_win,
     ) in raw_rows:
+        raw_row_count += 1
         record = PlayerBattleRecord(
             player_tag=str(player_tag),
             battle_log_id=str(battle_log_id),
@@ -433,9 +441,10 @@ def fetch_monitored_player_dataset(conn) -> MonitoredPlayerDataset:
             )
         duplicate_count += 1
 
+    cursor.close()
     battles = list(deduped_battles.values())
 
-    logger.info("監視対象プレイヤーのバトル件数(重複除外前): %d", len(raw_rows))
+    logger.info("監視対象プレイヤーのバトル件数(重複除外前): %d", raw_row_count)
     logger.info("重複除外済みバトル件数: %d", len(battles))
     if duplicate_count:
         logger.info("除外した重複バトル件数: %d", duplicate_count)
@@ -555,8 +564,7 @@ def export_monitored_player_stats(dataset: MonitoredPlayerDataset, output: Path)
 
     stats = compute_monitored_player_stats(dataset)
     output.parent.mkdir(parents=True, exist_ok=True)
-    with open(output, "w", encoding="utf-8") as fp:
-        json.dump(stats, fp, ensure_ascii=False, indent=2)
+    write_json(output, stats)
     logger.info("監視対象プレイヤー統計を出力しました: %s", output)
 
 
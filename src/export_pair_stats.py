@@ -1,7 +1,6 @@
 """マップごとのキャラクター対キャラクターの強さと仲間としての相性をJSONで出力するスクリプト."""
 
 import argparse
-import json
 import logging
 import math
 from collections import defaultdict
@@ -10,66 +9,145 @@ from typing import Dict, List, Tuple
 from pathlib import Path
 
 import mysql.connector
-from scipy.stats import beta
 
+from .beta_stats import beta_lcb
 from .db import get_connection
+from .json_utils import write_json
 from .logging_config import setup_logging
-from .settings import CONFIDENCE_LEVEL, DATA_RETENTION_DAYS
-from .stats_loader import StatsDataset, load_recent_ranked_battles
+from .settings import CONFIDENCE_LEVEL, DATA_RETENTION_DAYS, MIN_RANK_ID
+from .stats_loader import StatsDataset
 
 logger = logging.getLogger(__name__)
 JST = timezone(timedelta(hours=9))
-MIN_BETA_SHAPE = 1e-6
+# 複合キーをパックする際のキャラクターIDのビット幅
+BRAWLER_KEY_BITS = 32
+BRAWLER_KEY_MASK = (1 << BRAWLER_KEY_BITS) - 1
 
 
-def beta_lcb(alpha: float, beta_param: float, confidence: float = CONFIDENCE_LEVEL) -> float:
-    """Beta分布の下側信頼限界を計算する"""
-    alpha_safe = max(alpha, MIN_BETA_SHAPE)
-    beta_safe = max(beta_param, MIN_BETA_SHAPE)
-    return beta.ppf(1 - confidence, alpha_safe, beta_safe)
+def _unpack_pair_key(key: int) -> Tuple[int, int, int]:
+    """パック済みキーを (map_id, brawler_a, brawler_b) に戻す."""
 
+    return (
+        key >> (2 * BRAWLER_KEY_BITS),
+        (key >> BRAWLER_KEY_BITS) & BRAWLER_KEY_MASK,
+        key & BRAWLER_KEY_MASK,
+    )
+
+
+def _pair_rows(stats: Dict[int, List[int]]) -> List[Tuple[int, int, int, int, int]]:
+    rows: List[Tuple[int, int, int, int, int]] = []
+    for key, (wins, losses) in stats.items():
+        map_id, brawler_a, brawler_b = _unpack_pair_key(key)
+        rows.append((map_id, brawler_a, brawler_b, wins, losses))
+    return rows
 
-def fetch_matchup_stats(dataset: StatsDataset) -> List[Tuple[int, int, int, float, float]]:
+
+def fetch_matchup_stats(dataset: StatsDataset) -> List[Tuple[int, int, int, int, int]]:
     """共通データセットから対キャラ勝敗集計を生成する."""
 
-    stats: Dict[Tuple[int, int, int], Dict[str, float]] = defaultdict(
-        lambda: {"wins": 0.0, "losses": 0.0}
-    )
+    # (map_id, brawler_a, brawler_b) のタプルの代わりに1つの整数へパックしたキーで集計し、
+    # ペアごとのタプル生成とハッシュ計算を避ける。値は [wins, losses] のリスト。
+    stats: Dict[int, List[int]] = defaultdict(lambda: [0, 0])
     for battle in dataset.iter_ranked_battles():
         if not battle.win_brawlers or not battle.lose_brawlers:
             continue
+        map_key = battle.map_id << (2 * BRAWLER_KEY_BITS)
         for winner in battle.win_brawlers:
+            winner_key = map_key | (winner << BRAWLER_KEY_BITS)
             for loser in battle.lose_brawlers:
-                stats[(battle.map_id, winner, loser)]["wins"] += 1.0
-                stats[(battle.map_id, loser, winner)]["losses"] += 1.0
+                stats[winner_key | loser][0] += 1
+                stats[map_key | (loser << BRAWLER_KEY_BITS) | winner][1] += 1
 
-    rows: List[Tuple[int, int, int, float, float]] = []
-    for (map_id, brawler_a, brawler_b), record in stats.items():
-        rows.append((map_id, brawler_a, brawler_b, record["wins"], record["losses"]))
-    return rows
+    return _pair_rows(stats)
 
 
-def fetch_synergy_stats(dataset: StatsDataset) -> List[Tuple[int, int, int, float, float]]:
+def fetch_synergy_stats(dataset: StatsDataset) -> List[Tuple[int, int, int, int, int]]:
     """共通データセットから味方同士の勝敗集計を生成する."""
 
-    stats: Dict[Tuple[int, int, int], Dict[str, float]] = defaultdict(
-        lambda: {"wins": 0.0, "losses": 0.0}
-    )
+    stats: Dict[int, List[int]] = defaultdict(lambda: [0, 0])
     for battle in dataset.iter_ranked_battles():
-        if battle.win_brawlers and len(battle.win_brawlers) >= 2:
-            winners = sorted(battle.win_brawlers)
-            for i, brawler_a in enumerate(winners):
-                for brawler_b in winners[i + 1 :]:
-                    stats[(battle.map_id, brawler_a, brawler_b)]["wins"] += 1.0
-        if battle.lose_brawlers and len(battle.lose_brawlers) >= 2:
-            losers = sorted(battle.lose_brawlers)
-            for i, brawler_a in enumerate(losers):
-                for brawler_b in losers[i + 1 :]:
-                    stats[(battle.map_id, brawler_a, brawler_b)]["losses"] += 1.0
-
-    rows: List[Tuple[int, int, int, float, float]] = []
-    for (map_id, brawler_a, brawler_b), record in stats.items():
-        rows.append((map_id, brawler_a, brawler_b, record["wins"], record["losses"]))
+        map_key = battle.map_id << (2 * BRAWLER_KEY_BITS)
+        for team, result_idx in ((battle.win_brawlers, 0), (battle.lose_brawlers, 1)):
+            if not team or len(team) < 2:
+                continue
+            members = sorted(team)
+            for i, brawler_a in enumerate(members):
+                a_key = map_key | (brawler_a << BRAWLER_KEY_BITS)
+                for brawler_b in members[i + 1 :]:
+                    stats[a_key | brawler_b][result_idx] += 1
+
+    return _pair_rows(stats)
+
+
+def fetch_matchup_stats_from_db(conn, since: str) -> List[Tuple[int, int, int, int, int]]:
+    """対キャラ勝敗集計を GROUP BY でDB側に計算させて取得する.
+
+    win_lose_logs は勝者×敗者の組み合わせを1バトルにつき1行ずつ保持しているため、
+    マップと組み合わせ単位の COUNT(*) がそのまま対キャラの勝利数になる。
+    """
+
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT rl.map_id, wl.win_brawler_id, wl.lose_brawler_id, COUNT(*) AS cnt
+        FROM win_lose_logs wl
+        JOIN battle_logs bl ON wl.battle_log_id = bl.id
+        JOIN rank_logs rl ON bl.rank_log_id = rl.id
+        WHERE rl.rank_id >= %s AND rl.id >= %s
+        GROUP BY rl.map_id, wl.win_brawler_id, wl.lose_brawler_id
+        """,
+        (MIN_RANK_ID, since),
+    )
+    stats: Dict[Tuple[int, int, int], List[int]] = defaultdict(lambda: [0, 0])
+    for map_id, winner, loser, cnt in cursor:
+        stats[(int(map_id), int(winner), int(loser))][0] += int(cnt)
+        stats[(int(map_id), int(loser), int(winner))][1] += int(cnt)
+    cursor.close()
+
+    rows: List[Tuple[int, int, int, int, int]] = []
+    for (map_id, brawler_a, brawler_b), (wins, losses) in stats.items():
+        rows.append((map_id, brawler_a, brawler_b, wins, losses))
+    return rows
+
+
+def fetch_synergy_stats_from_db(conn, since: str) -> List[Tuple[int, int, int, int, int]]:
+    """味方同士の勝敗集計を自己結合と GROUP BY でDB側に計算させて取得する."""
+
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        WITH battle_sides AS (
+            SELECT DISTINCT wl.battle_log_id, rl.map_id, wl.win_brawler_id AS brawler_id, 1 AS is_win
+            FROM win_lose_logs wl
+            JOIN battle_logs bl ON wl.battle_log_id = bl.id
+            JOIN rank_logs rl ON bl.rank_log_id = rl.id
+            WHERE rl.rank_id >= %s AND rl.id >= %s
+            UNION
+            SELECT DISTINCT wl.battle_log_id, rl.map_id, wl.lose_brawler_id AS brawler_id, 0 AS is_win
+            FROM win_lose_logs wl
+            JOIN battle_logs bl ON wl.battle_log_id = bl.id
+            JOIN rank_logs rl ON bl.rank_log_id = rl.id
+            WHERE rl.rank_id >= %s AND rl.id >= %s
+        )
+        SELECT a.map_id,
+               a.brawler_id AS brawler_a,
+               b.brawler_id AS brawler_b,
+               SUM(a.is_win) AS wins,
+               SUM(1 - a.is_win) AS losses
+        FROM battle_sides a
+        JOIN battle_sides b
+            ON a.battle_log_id = b.battle_log_id
+           AND a.is_win = b.is_win
+           AND a.brawler_id < b.brawler_id
+        GROUP BY a.map_id, a.brawler_id, b.brawler_id
+        """,
+        (MIN_RANK_ID, since, MIN_RANK_ID, since),
+    )
+    rows: List[Tuple[int, int, int, int, int]] = [
+        (int(map_id), int(brawler_a), int(brawler_b), int(wins), int(losses))
+        for map_id, brawler_a, brawler_b, wins, losses in cursor
+    ]
+    cursor.close()
     return rows
 
 
@@ -140,12 +218,12 @@ def main() -> None:
         raise SystemExit(f"データベースに接続できません: {e}")
 
     try:
+        # 単独実行時は共通データセットを読み込まず、集計をDB側の GROUP BY に任せる
         logger.info("対キャラデータを取得しています...")
-        dataset = load_recent_ranked_battles(conn, since)
-        matchup_rows = fetch_matchup_stats(dataset)
+        matchup_rows = fetch_matchup_stats_from_db(conn, since)
         logger.info("%d 行の対キャラデータを取得", len(matchup_rows))
         logger.info("協力データを取得しています...")
-        synergy_rows = fetch_synergy_stats(dataset)
+        synergy_rows = fetch_synergy_stats_from_db(conn, since)
         logger.info("%d 行の協力データを取得", len(synergy_rows))
     except mysql.connector.Error as e:
         raise SystemExit(f"クエリの実行に失敗しました: {e}")
@@ -162,9 +240,7 @@ def main() -> None:
         kind_dir = base_dir / kind
         kind_dir.mkdir(parents=True, exist_ok=True)
         for map_id, data in maps.items():
-            out_file = kind_dir / f"{map_id}.json"
-            with open(out_file, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            write_json(kind_dir / f"{map_id}.json", data)
     logger.info("JSON出力が完了しました")
 
 
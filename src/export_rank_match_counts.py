@@ -1,13 +1,14 @@
 """指定ランク以上のランクマッチ数をJSONとして出力するスクリプト."""
 
 import argparse
-import json
 import logging
+from pathlib import Path
 from typing import List, TypedDict
 
 import mysql.connector
 
 from .db import get_connection
+from .json_utils import write_json
 from .logging_config import setup_logging
 from .settings import MIN_RANK_ID
 
@@ -84,8 +85,7 @@ def main() -> None:
         conn.close()
 
     logger.info("JSONファイルに書き込んでいます: %s", args.output)
-    with open(args.output, "w", encoding="utf-8") as fp:
-        json.dump(results, fp, ensure_ascii=False, indent=2)
+    write_json(Path(args.output), results)
     logger.info("JSON出力が完了しました")
 
 
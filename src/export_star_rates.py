@@ -1,15 +1,16 @@
 """スター取得率をマップ・キャラ別に集計してJSON出力するスクリプト."""
 
 import argparse
-import json
 import logging
 from collections import defaultdict
 from datetime import datetime, timedelta, timezone
+from pathlib import Path
 from typing import Dict, List, Tuple
 
 import mysql.connector
 
 from .db import get_connection
+from .json_utils import write_json
 from .logging_config import setup_logging
 from .settings import DATA_RETENTION_DAYS
 from .stats_loader import StatsDataset, load_recent_ranked_battles
@@ -102,8 +103,7 @@ def main() -> None:
     stats = compute_star_rates(rows)
 
     logger.info("JSONファイルに書き込んでいます: %s", args.output)
-    with open(args.output, "w", encoding="utf-8") as fp:
-        json.dump(stats, fp, ensure_ascii=False, indent=2)
+    write_json(Path(args.output), stats)
     logger.info("JSON出力が完了しました")
 
 
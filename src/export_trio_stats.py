@@ -2,7 +2,6 @@
 from __future__ import annotations
 
 import argparse
-import json
 import logging
 import shutil
 from datetime import datetime, timedelta, timezone
@@ -12,6 +11,7 @@ from typing import Dict, List, Optional
 import mysql.connector
 
 from .db import get_connection
+from .json_utils import write_json
 from .logging_config import setup_logging
 from .settings import CONFIDENCE_LEVEL, DATA_RETENTION_DAYS
 from .stats_loader import load_recent_ranked_battles
@@ -40,9 +40,7 @@ def export_trio_json(
             }
             for combo in combos
         ]
-        out_file = output_dir / f"{map_id}.json"
-        with open(out_file, "w", encoding="utf-8") as f:
-            json.dump(simplified, f, ensure_ascii=False, indent=2)
+        write_json(output_dir / f"{map_id}.json", simplified)
 
 
 def main() -> None:
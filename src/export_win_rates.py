@@ -6,96 +6,118 @@
 """
 
 import argparse
-import json
 import logging
-import math
-from collections import defaultdict
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Tuple
+from pathlib import Path
+from typing import Dict, List
 
 import mysql.connector
-from scipy.stats import beta
+import numpy as np
 
+from .beta_stats import beta_lcb_array
 from .db import get_connection
+from .json_utils import write_json
 from .logging_config import setup_logging
 from .stats_loader import StatsDataset, load_recent_ranked_battles
 from .settings import CONFIDENCE_LEVEL, DATA_RETENTION_DAYS
 
 logger = logging.getLogger(__name__)
-MIN_BETA_SHAPE = 1e-6
-
-
-def beta_lcb(alpha: float, beta_param: float, confidence: float = CONFIDENCE_LEVEL) -> float:
-    """Beta分布の下側信頼限界を求める"""
-    alpha_safe = max(alpha, MIN_BETA_SHAPE)
-    beta_safe = max(beta_param, MIN_BETA_SHAPE)
-    return float(beta.ppf(1 - confidence, alpha_safe, beta_safe))
+# 複合キーをパックする際のキャラクターIDのビット幅
+BRAWLER_KEY_BITS = 32
+BRAWLER_KEY_MASK = (1 << BRAWLER_KEY_BITS) - 1
 
 
 def fetch_stats(dataset: StatsDataset) -> List[tuple]:
     """共通データセットから勝敗集計を生成する."""
 
-    stats: Dict[Tuple[int, int], Dict[str, float]] = defaultdict(
-        lambda: {"wins": 0.0, "losses": 0.0}
+    map_ids, brawler_ids, is_win = dataset.participant_arrays()
+    if map_ids.size == 0:
+        return []
+
+    # (map_id, brawler_id) を1つの int64 にパックし、1次元の np.unique で集約する
+    keys = (map_ids << BRAWLER_KEY_BITS) | brawler_ids
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    # 重み付き bincount は float64 になるため、勝利行だけを数えて整数のまま集計する
+    wins = np.bincount(inverse[is_win], minlength=len(unique_keys))
+    losses = np.bincount(inverse[~is_win], minlength=len(unique_keys))
+
+    return list(
+        zip(
+            (unique_keys >> BRAWLER_KEY_BITS).tolist(),
+            (unique_keys & BRAWLER_KEY_MASK).tolist(),
+            wins.tolist(),
+            losses.tolist(),
+        )
     )
-    for battle in dataset.iter_ranked_battles():
-        if battle.win_brawlers:
-            for brawler_id in battle.win_brawlers:
-                stats[(battle.map_id, brawler_id)]["wins"] += 1.0
-        if battle.lose_brawlers:
-            for brawler_id in battle.lose_brawlers:
-                stats[(battle.map_id, brawler_id)]["losses"] += 1.0
-
-    rows: List[tuple] = []
-    for (map_id, brawler_id), record in stats.items():
-        rows.append((map_id, brawler_id, record["wins"], record["losses"]))
-    return rows
 
 
 def compute_win_rates(
     rows: List[tuple], *, confidence: float = CONFIDENCE_LEVEL
 ) -> Dict[int, Dict[int, Dict[str, float]]]:
     logger.info("データを集計しています...")
-    # map_id -> brawler_tag -> {wins, games}
-    stats: Dict[int, Dict[int, Dict[str, float]]] = defaultdict(
-        lambda: defaultdict(lambda: {"wins": 0.0, "games": 0.0})
-    )
-    for map_id, brawler_id, wins, losses in rows:
-        # MySQLコネクタは SUM 関数の結果を decimal.Decimal で返すため
-        # float と混在すると演算で TypeError が発生する。
-        # ここではすべての値を明示的に float に変換して集計する。
-        wins_f = float(wins)
-        losses_f = float(losses)
-        stats[map_id][brawler_id]["wins"] += wins_f
-        stats[map_id][brawler_id]["games"] += wins_f + losses_f
+    if not rows:
+        return {}
+    # MySQLコネクタは SUM 関数の結果を decimal.Decimal で返すため
+    # ここですべての値を明示的に float に変換して配列化する。
+    count = len(rows)
+    map_ids = np.fromiter((int(r[0]) for r in rows), dtype=np.int64, count=count)
+    brawler_ids = np.fromiter((int(r[1]) for r in rows), dtype=np.int64, count=count)
+    wins_in = np.fromiter((float(r[2]) for r in rows), dtype=np.float64, count=count)
+    losses_in = np.fromiter((float(r[3]) for r in rows), dtype=np.float64, count=count)
+
+    # 同一 (map_id, brawler_id) の行を合算する
+    keys = (map_ids << BRAWLER_KEY_BITS) | brawler_ids
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    wins = np.bincount(inverse, weights=wins_in, minlength=len(unique_keys))
+    games = np.bincount(inverse, weights=wins_in + losses_in, minlength=len(unique_keys))
 
     logger.info("勝率を計算しています...")
+    # マップ単位の事前分布を集約し、各キャラクター行へ展開する
+    pair_map_ids = unique_keys >> BRAWLER_KEY_BITS
+    unique_maps, map_inverse, brawler_counts = np.unique(
+        pair_map_ids, return_inverse=True, return_counts=True
+    )
+    map_inverse = map_inverse.reshape(-1)
+    total_wins = np.bincount(map_inverse, weights=wins, minlength=len(unique_maps))
+    total_games = np.bincount(map_inverse, weights=games, minlength=len(unique_maps))
+    valid_maps = total_games != 0
+    safe_total_games = np.where(valid_maps, total_games, 1.0)
+    mean = total_wins / safe_total_games
+    strength = total_games / brawler_counts
+    alpha_prior = (mean * strength)[map_inverse]
+    beta_prior = ((1 - mean) * strength)[map_inverse]
+
+    # 全マップ・全キャラクター分を1回の beta.ppf で計算する
+    lcbs = beta_lcb_array(
+        alpha_prior + wins,
+        beta_prior + games - wins,
+        confidence=confidence,
+    )
+    keep = np.isfinite(lcbs) & valid_maps[map_inverse]
+
+    # unique_keys はソート済みで同じマップの行が連続するため、マップ境界で切り分けて
+    # マップごとの辞書を dict(zip(...)) で一度に組み立てる
+    kept_map_ids = pair_map_ids[keep]
+    kept_brawler_ids = (unique_keys[keep] & BRAWLER_KEY_MASK).tolist()
+    kept_games = np.rint(games[keep]).astype(np.int64).tolist()
+    kept_lcbs = lcbs[keep].tolist()
+    bounds = np.searchsorted(kept_map_ids, unique_maps, side="left").tolist()
+    bounds.append(len(kept_brawler_ids))
+
     results: Dict[int, Dict[int, Dict[str, float]]] = {}
-    total_maps = len(stats)
-    for idx, (map_id, brawlers) in enumerate(stats.items(), 1):
-        # logging.info("%d/%d %s を処理中", idx, total_maps, map_id)
-        total_wins = sum(v["wins"] for v in brawlers.values())
-        total_games = sum(v["games"] for v in brawlers.values())
-        if total_games == 0 or len(brawlers) == 0:
-            results[map_id] = {}
-            continue
-        mean = total_wins / total_games
-        strength = total_games / len(brawlers)
-        alpha_prior = mean * strength
-        beta_prior = (1 - mean) * strength
-
-        map_result: Dict[int, Dict[str, float]] = {}
-        for brawler_id, val in brawlers.items():
-            alpha_post = alpha_prior + val["wins"]
-            beta_post = beta_prior + val["games"] - val["wins"]
-            lcb = beta_lcb(alpha_post, beta_post, confidence=confidence)
-            if not math.isfinite(lcb):
-                continue
-            map_result[brawler_id] = {
-                "games": int(round(val["games"])),
-                "win_rate_lcb": lcb,
-            }
-        results[map_id] = map_result
+    for idx, map_id in enumerate(unique_maps.tolist()):
+        start, end = bounds[idx], bounds[idx + 1]
+        results[map_id] = dict(
+            zip(
+                kept_brawler_ids[start:end],
+                (
+                    {"games": games_val, "win_rate_lcb": lcb}
+                    for games_val, lcb in zip(kept_games[start:end], kept_lcbs[start:end])
+                ),
+            )
+        )
     return results
 
 
@@ -126,8 +148,7 @@ def main() -> None:
 
     result = compute_win_rates(rows, confidence=CONFIDENCE_LEVEL)
     logger.info("JSONファイルに書き込んでいます: %s", args.output)
-    with open(args.output, "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
+    write_json(Path(args.output), result)
     logger.info("JSON出力が完了しました")
 
 
@@ -2,9 +2,12 @@ import argparse
 import json
 import logging
 import os
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from dataclasses import dataclass, field
+from itertools import product
 from datetime import datetime, timedelta, timezone
 from typing import Optional, Sequence, Tuple
 from mysql.connector import IntegrityError, errorcode
@@ -17,12 +20,13 @@ from urllib.parse import quote
 
 from .country_code import COUNTRY_CODE
 from .db import get_connection
+from .json_utils import loads as load_json
 from .map import MAP_NAME_TO_ID
 from .rank import RANK_TO_ID
 from .logging_config import setup_logging
 from .settings import DATA_RETENTION_DAYS, MIN_RANK_ID, load_environment
 
-# リクエスト間隔（秒）
+# リクエスト間隔（秒）。全ワーカー共通のトークン補充間隔として使う
 REQUEST_INTERVAL = 0.01
 # 最大リトライ回数
 MAX_RETRIES = 3
@@ -32,14 +36,18 @@ DEFAULT_ACQ_CYCLE_HOURS = 6
 TROPHIE_BORDER = 5000
 # DB に登録する最低ランク（これ未満は保存しない）
 MIN_REGISTER_RANK = 13
-# 一度に取得するプレイヤー数
-FETCH_BATCH_SIZE = 10
+# 一度にDBから取り出して処理するプレイヤー数
+FETCH_BATCH_SIZE = 500
 # 並列取得時の最大ワーカー数
 MAX_WORKERS = 10
 # API リクエストのタイムアウト (接続タイムアウト, 読み取りタイムアウト)
 REQUEST_TIMEOUT = (5, 30)
 # 一度の削除で扱うランクログIDの上限
 DELETE_CHUNK_SIZE = 1000
+# デッドロック・ロック待ちタイムアウト時にバトルログ登録をやり直す最大回数
+STORE_MAX_RETRIES = 3
+# 再試行で解消が見込めるロック関連のエラー
+LOCK_RETRY_ERRNOS = frozenset({errorcode.ER_LOCK_DEADLOCK, errorcode.ER_LOCK_WAIT_TIMEOUT})
 
 
 def _create_http_session() -> requests.Session:
@@ -57,11 +65,61 @@ def _create_http_session() -> requests.Session:
 
 SESSION = _create_http_session()
 
+
+class TokenBucket:
+    """スレッド間で共有するトークンバケット方式のレートリミッタ.
+
+    リクエストのたびに固定時間スリープするとレスポンス待ちの時間まで上乗せされるため、
+    経過時間に応じてトークンを補充し、トークンが尽きたときだけ待機する。
+    """
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        if rate <= 0:
+            raise ValueError("rate は正の値で指定してください。")
+        if capacity < 1:
+            raise ValueError("capacity は1以上で指定してください。")
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated_at = now
+
+    def acquire(self) -> None:
+        """トークンを1つ消費する。残っていなければ補充されるまで待機する."""
+        with self._cond:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                self._cond.wait((1 - self._tokens) / self.rate)
+
+
+# 全ワーカーで共有するAPIリクエストのレートリミッタ
+RATE_LIMITER = TokenBucket(rate=1 / REQUEST_INTERVAL, capacity=MAX_WORKERS)
+
 # 逆結果マップ
 OPPOSITE = {"victory": "defeat", "defeat": "victory"}
+# API の battleTime 形式 (例: 20240812T123456.000Z)
+BATTLE_TIME_FORMAT = "%Y%m%dT%H%M%S.%fZ"
 
 JST = timezone(timedelta(hours=9))
 
+# ワーカースレッドごとに使い回すDB接続
+_WORKER_LOCAL = threading.local()
+_WORKER_CONNECTIONS: list = []
+_WORKER_CONNECTIONS_LOCK = threading.Lock()
+
+# モード名 -> _modes.id のキャッシュ（未登録マップの登録時に利用）
+_MODE_ID_CACHE: dict[str, int] = {}
+
 logger = logging.getLogger(__name__)
 
 @dataclass
@@ -122,13 +180,69 @@ def _update_player_profile_from_latest_battle(
     return player_name_in_db, player_highest_rank, player_current_rank
 
 
+def _get_worker_connection():
+    """呼び出し元スレッド専用のDB接続を取得する.
+
+    プレイヤーごとに接続を張り直すと認証やセッション初期化のコストが毎回かかるため、
+    ワーカースレッド単位で接続を保持して使い回す。
+    """
+    conn = getattr(_WORKER_LOCAL, "conn", None)
+    if conn is not None and conn.is_connected():
+        return conn
+    conn = get_connection()
+    _WORKER_LOCAL.conn = conn
+    with _WORKER_CONNECTIONS_LOCK:
+        _WORKER_CONNECTIONS.append(conn)
+    return conn
+
+
+def _close_worker_connections() -> None:
+    """ワーカースレッドが保持しているDB接続をすべて閉じる."""
+    with _WORKER_CONNECTIONS_LOCK:
+        connections = list(_WORKER_CONNECTIONS)
+        _WORKER_CONNECTIONS.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except mysql.connector.Error:
+            pass
+
+
+def _get_mode_id(cur, mode_name: str) -> Optional[int]:
+    """モード名から _modes のIDを取得する（結果はプロセス内でキャッシュする）."""
+    if mode_name in _MODE_ID_CACHE:
+        return _MODE_ID_CACHE[mode_name]
+    cur.execute("SELECT id FROM _modes WHERE name=%s", (mode_name,))
+    row = cur.fetchone()
+    mode_id = row[0] if row else None
+    if mode_id is not None:
+        _MODE_ID_CACHE[mode_name] = mode_id
+    return mode_id
+
+
+def _register_map(cur, map_id: int, map_name: str, mode_name: str) -> int:
+    """未登録のマップを _maps に登録し、以降の参照用にマップIDを返す.
+
+    REPLACE は既存行の DELETE を伴い rank_logs からの外部キー参照と衝突するため、
+    INSERT ... ON DUPLICATE KEY UPDATE で1文のUPSERTとして登録する。
+    """
+    mode_id = _get_mode_id(cur, mode_name)
+    cur.execute(
+        "INSERT INTO _maps(id, name, mode_id) VALUES (%s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE name=VALUES(name), mode_id=VALUES(mode_id)",
+        (map_id, map_name, mode_id),
+    )
+    MAP_NAME_TO_ID[map_name] = map_id
+    return map_id
+
+
 def request_with_retry(
     url: str,
     headers: Optional[dict[str, str]] = None,
     method: str = "GET",
     timeout: Optional[Sequence[float] | float] = None,
     max_retries: int = MAX_RETRIES,
-    request_interval: float = REQUEST_INTERVAL,
+    rate_limiter: Optional[TokenBucket] = None,
 ) -> Tuple[Optional[requests.Response], Optional[int]]:
     """API にリクエストを送り、失敗した場合はリトライを行う汎用関数
 
@@ -148,9 +262,10 @@ def request_with_retry(
             raise ValueError("timeout は (connect, read) の2要素で指定してください。")
         timeout_values = (float(timeout_seq[0]), float(timeout_seq[1]))
 
+    limiter = rate_limiter or RATE_LIMITER
     for attempt in range(1, max_retries + 1):
         try:
-            time.sleep(request_interval)
+            limiter.acquire()
             resp = SESSION.request(
                 method,
                 url,
@@ -196,61 +311,69 @@ def request_with_retry(
 def cleanup_old_logs(conn) -> int:
     """設定された日数より前のログデータと低ランク(rank_id<=4)のログを削除"""
     cur = conn.cursor()
-    # 低ランクの履歴は保持対象外のため無条件に削除する
-    cur.execute(
-        """
-        SELECT id
-        FROM rank_logs
-        WHERE rank_id < %s
-        """,
-        (MIN_RANK_ID,),
-    )
-    low_rank_ids = [row[0] for row in cur.fetchall()]
     threshold = (datetime.now(JST) - timedelta(days=DATA_RETENTION_DAYS)).strftime("%Y%m%d")
+    # 低ランクの履歴は保持対象外のため無条件に削除し、
+    # 保持期間を過ぎた履歴は監視・最高ランク到達プレイヤーを含まないものだけ削除する。
+    # rank_logs.id は日付8桁で始まるため、日付文字列との直接比較で主キーの範囲検索になる
     cur.execute(
         """
         SELECT rl.id
         FROM rank_logs rl
-        WHERE SUBSTRING(rl.id, 1, 8) < %s
-          AND NOT EXISTS (
-              SELECT 1
-              FROM battle_logs bl
-              JOIN win_lose_logs wll ON wll.battle_log_id = bl.id
-              LEFT JOIN players wp ON wp.tag = wll.win_player_tag
-              LEFT JOIN players lp ON lp.tag = wll.lose_player_tag
-              WHERE bl.rank_log_id = rl.id
-                AND (
-                    wp.is_monitored = 1
-                    OR lp.is_monitored = 1
-                    OR wp.highest_rank = 22
-                    OR lp.highest_rank = 22
-                )
-          )
+        WHERE rl.rank_id < %s
+           OR (
+              rl.id < %s
+              AND NOT EXISTS (
+                  SELECT 1
+                  FROM battle_logs bl
+                  JOIN win_lose_logs wll ON wll.battle_log_id = bl.id
+                  LEFT JOIN players wp ON wp.tag = wll.win_player_tag
+                  LEFT JOIN players lp ON lp.tag = wll.lose_player_tag
+                  WHERE bl.rank_log_id = rl.id
+                    AND (
+                        wp.is_monitored = 1
+                        OR lp.is_monitored = 1
+                        OR wp.highest_rank = 22
+                        OR lp.highest_rank = 22
+                    )
+              )
+           )
         """,
-        (threshold,),
+        (MIN_RANK_ID, threshold),
     )
-    old_rank_ids = [row[0] for row in cur.fetchall()]
-    rank_ids_to_delete = list(set(low_rank_ids) | set(old_rank_ids))
+    rank_ids_to_delete = [row[0] for row in cur.fetchall()]
     if not rank_ids_to_delete:
         return 0
     deleted = 0
+    # 外部キーの参照順に子テーブルから削除する。複数テーブル DELETE は
+    # 削除順がオプティマイザ任せで外部キー違反になり得るため、チャンクごとに
+    # 3文を1トランザクションにまとめて途中状態が残らないようにする
     for start in range(0, len(rank_ids_to_delete), DELETE_CHUNK_SIZE):
         chunk = rank_ids_to_delete[start : start + DELETE_CHUNK_SIZE]
         placeholders = ",".join("%s" for _ in chunk)
-        cur.execute(
-            f"DELETE FROM win_lose_logs WHERE battle_log_id IN (SELECT id FROM battle_logs WHERE rank_log_id IN ({placeholders}))",
-            chunk,
-        )
-        cur.execute(
-            f"DELETE FROM battle_logs WHERE rank_log_id IN ({placeholders})",
-            chunk,
-        )
-        cur.execute(
-            f"DELETE FROM rank_logs WHERE id IN ({placeholders})",
-            chunk,
-        )
+        conn.start_transaction()
+        try:
+            cur.execute(
+                f"""
+                DELETE wl
+                FROM win_lose_logs wl
+                JOIN battle_logs bl ON wl.battle_log_id = bl.id
+                WHERE bl.rank_log_id IN ({placeholders})
+                """,
+                chunk,
+            )
+            cur.execute(
+                f"DELETE FROM battle_logs WHERE rank_log_id IN ({placeholders})",
+                chunk,
+            )
+            cur.execute(
+                f"DELETE FROM rank_logs WHERE id IN ({placeholders})",
+                chunk,
+            )
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
         deleted += len(chunk)
-    conn.commit()
     return deleted
 
 def _build_player_filter_clause(
@@ -295,7 +418,7 @@ def fetch_rank_player(api_key: str, conn) -> int:
             continue
 
         try:
-            data = resp.json()
+            data = load_json(resp.content)
         except json.JSONDecodeError as e:
             logger.error("JSON の解析に失敗しました: %s", e)
             continue
@@ -303,35 +426,352 @@ def fetch_rank_player(api_key: str, conn) -> int:
         rank_players = data.get("items", [])
 
         count = 0
-        tags_to_insert: list[tuple[str]] = []
+        tags_to_insert: list[str] = []
         for player in rank_players:
             p_t = player.get("trophies", 0)
             if TROPHIE_BORDER < p_t or p_t == 1:
                 count += 1
                 p_tag = player.get("tag")
                 if p_tag:
-                    tags_to_insert.append((p_tag,))
+                    tags_to_insert.append(p_tag)
         if tags_to_insert:
-            cur.executemany(
-                "INSERT IGNORE INTO players(tag) VALUES (%s)",
+            # executemany は INSERT IGNORE を1行ずつ実行するため、複数行 VALUES を組み立てる
+            values = ",".join(["(%s)"] * len(tags_to_insert))
+            cur.execute(
+                f"INSERT IGNORE INTO players(tag) VALUES {values}",
                 tags_to_insert,
             )
             if cur.rowcount > 0:
                 new_players += cur.rowcount
 
         logger.info("国コード:%s 取得プレイヤー数 %d", code, count)
-        conn.commit()
 
+    conn.commit()
     return new_players
 
 
+def _parse_battle_time(battle_time: str) -> datetime:
+    """battleTime を UTC の datetime に変換する.
+
+    固定書式の strptime を優先し、想定外の書式の場合のみ dateutil の汎用パーサを使う。
+    """
+
+    try:
+        return datetime.strptime(battle_time, BATTLE_TIME_FORMAT).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return parse(battle_time)
+
+
+def _insert_win_lose_logs(cur, rows: Sequence[tuple]) -> None:
+    """勝敗ログを複数行の INSERT IGNORE 1文でまとめて登録する.
+
+    mysql-connector の executemany が複数行 VALUES に書き換えるのは
+    ``INSERT INTO`` で始まる文だけで、``INSERT IGNORE`` は1行ずつ実行されるため
+    VALUES 句を自前で組み立てる。
+    """
+
+    values = ",".join(["(%s, %s, %s, %s, %s)"] * len(rows))
+    cur.execute(
+        "INSERT IGNORE INTO win_lose_logs(win_brawler_id, win_player_tag, lose_brawler_id, lose_player_tag, battle_log_id)"
+        f" VALUES {values}",
+        [value for row in rows for value in row],
+    )
+
+
+def _store_battle_logs(
+    cur, player_tag: str, battle_logs: Sequence[dict]
+) -> tuple[int, int, int]:
+    """取得済みのバトルログをDBへ保存し、新規登録件数を返す."""
+    new_players = 0
+    new_rank_logs = 0
+    new_battle_logs = 0
+
+    cur.execute(
+        "SELECT name, highest_rank, current_rank FROM players WHERE tag=%s",
+        (player_tag,),
+    )
+    row = cur.fetchone()
+    player_name_in_db = (row[0] if row and row[0] else None)
+    player_highest_rank = row[1] if row and row[1] is not None else 0
+    player_current_rank = row[2] if row and row[2] is not None else 0
+
+    (
+        player_name_in_db,
+        player_highest_rank,
+        player_current_rank,
+    ) = _update_player_profile_from_latest_battle(
+        cur,
+        battle_logs,
+        player_tag,
+        player_name_in_db,
+        player_highest_rank,
+        player_current_rank,
+    )
+
+    cur.execute(
+        "UPDATE players SET last_fetched=%s WHERE tag=%s",
+        (datetime.now(JST), player_tag),
+    )
+
+    # 対戦相手・味方の登録とプロフィール更新はタグごとにまとめて最後に反映する
+    discovered_names: dict[str, str] = {}
+    discovered_ranks: dict[str, tuple[int, int]] = {}
+
+    # ランクマッチの登録有無をバトルごとに問い合わせず、候補IDをまとめて1回で確認する
+    candidate_rank_log_ids: list[str] = []
+    for battle in battle_logs:
+        battle_detail = battle.get("battle", {})
+        if battle_detail.get("type") != "soloRanked":
+            continue
+        star_tag = (battle_detail.get("starPlayer") or {}).get("tag")
+        if star_tag:
+            candidate_rank_log_ids.append(f"{battle.get('battleTime', '不明')}_{star_tag}")
+    existing_rank_log_ids: set[str] = set()
+    if candidate_rank_log_ids:
+        placeholders = ",".join(["%s"] * len(candidate_rank_log_ids))
+        cur.execute(
+            f"SELECT id FROM rank_logs WHERE id IN ({placeholders})",
+            candidate_rank_log_ids,
+        )
+        existing_rank_log_ids = {row[0] for row in cur.fetchall()}
+
+    win_lose_rows: list[tuple] = []
+
+    # 保持期間より古いバトルは登録しない
+    col_start_date = datetime.now(JST) - timedelta(days=DATA_RETENTION_DAYS)
+
+    rank = 0
+    new_rank_flag = False            
+    new_rank_brawlers_flag = False   
+    rank_log_id = None   
+
+    for battle in battle_logs:       
+        battle_detail = battle.get("battle", {})
+        if battle_detail.get("type") != "soloRanked":
+            continue
+        event = battle.get("event", {})
+        battle_map_id = event.get("id", "不明")
+        battle_mode = event.get("mode", "不明")
+        battle_map = event.get("map", "不明")
+        battle_time = battle.get("battleTime", "不明")
+        battle_datetime = _parse_battle_time(battle_time).astimezone(JST)
+        if battle_datetime < col_start_date:
+            continue
+        star_player = battle_detail.get("starPlayer") or {}
+        star_player_tag = star_player.get("tag")
+        star_brawler_id = (
+            star_player.get("brawler", {}).get("id")
+            if isinstance(star_player.get("brawler"), dict)
+            else None
+        )
+        if star_player_tag:
+            new_rank_flag = True
+            # ランクマッチ(または同一グループ)開始時にランクをリセット
+            rank = 0
+            rank_log_id = f"{battle_time}_{star_player_tag}"
+            # ここですでに存在しているランクマッチを確認
+            if rank_log_id in existing_rank_log_ids:
+                # print(f"既に記録済みのランクマッチ: {rank_log_id}")
+                new_rank_flag = False
+                continue
+            else:
+                new_rank_brawlers_flag = True
+        elif not new_rank_flag:
+            continue
+
+        result = battle_detail.get("result", "不明")
+        teams = battle_detail.get("teams", [])
+        resultInfo: list[ResultLog] = []
+
+        my_side_idx = None  # 自分がいるチーム(0/1)
+
+        for side_idx,team in enumerate(teams):
+            resultLog = ResultLog()
+            for player in team:
+                brawler = player.get("brawler") or {}
+                brawler_id = brawler.get("id")
+                p_tag = player.get("tag")
+                resultLog.brawlers.append((brawler_id, p_tag))
+                player_name = player.get("name")
+                trophies = brawler.get("trophies", 0)
+                if p_tag == player_tag:
+                    my_side_idx = side_idx
+                    resultLog.result = result
+                    # if trophies < 7:
+                    #     cur.execute("DELETE FROM players WHERE tag=%s", (player_tag,))
+                    #     if cur.rowcount == 1:  # 削除されたら1、既に存在しなかったら0
+                    #         logger.info("プレイヤー削除:%s", player_tag)
+                if p_tag and 16 < trophies <= 22:
+                    if player_name:
+                        discovered_names.setdefault(p_tag, player_name)
+                    # バトルログは新しい順に並ぶため、最初に出現したランクを現在ランクとする
+                    current, highest = discovered_ranks.get(p_tag, (trophies, trophies))
+                    discovered_ranks[p_tag] = (current, max(highest, trophies))
+                if rank < trophies <= 22:
+                    rank = trophies
+            resultInfo.append(resultLog)
+        if my_side_idx is not None and len(resultInfo) == 2 and result in OPPOSITE:
+            other = 1 - my_side_idx
+            # まだ埋まっていない場合のみ上書き
+            if getattr(resultInfo[other], "result", "不明") in (None, "", "不明"):
+                resultInfo[other].result = OPPOSITE[result]
+
+        # ランクが低い履歴は登録しない
+        if rank < MIN_REGISTER_RANK:
+            logger.debug(
+                "ランク%d未満(%d)のため登録スキップ rank_log_id=%s",
+                MIN_REGISTER_RANK,
+                rank,
+                rank_log_id,
+            )
+            new_rank_flag = False
+            new_rank_brawlers_flag = False
+            rank_log_id = None
+            continue
+
+        if new_rank_brawlers_flag:
+            map_id = MAP_NAME_TO_ID.get(battle_map)
+            rank_id = RANK_TO_ID.get(rank)
+            rank_log_id = f"{battle_time}_{star_player_tag}"
+            #新規ランクマッチ登録
+            inserted_rank_log = False
+            try:
+                cur.execute(
+                    "INSERT INTO rank_logs(id, map_id, rank_id) VALUES (%s, %s, %s)",
+                    (rank_log_id, map_id, rank_id),
+                )
+                if cur.rowcount > 0:
+                    new_rank_logs += cur.rowcount
+                    inserted_rank_log = True
+            except IntegrityError as e:
+                if e.errno == errorcode.ER_DUP_ENTRY:  # 1062: Duplicate entry
+                    logger.info("重複レコードなのでスキップ")
+                    new_rank_flag = False
+                    new_rank_brawlers_flag = False
+                    continue
+                logger.warning(
+                    "未登録のマップを検出: マップ=%s マップID=%s ランク=%s",
+                    battle_map,
+                    battle_map_id,
+                    rank,
+                )
+                logger.warning("Battle detail: %s error: %s", battle, e)
+                map_id = _register_map(cur, battle_map_id, battle_map, battle_mode)
+                cur.execute(
+                    "INSERT INTO rank_logs(id, map_id, rank_id) VALUES (%s, %s, %s)",
+                    (rank_log_id, map_id, rank_id),
+                )
+                if cur.rowcount > 0:
+                    new_rank_logs += cur.rowcount
+                    inserted_rank_log = True
+            if inserted_rank_log:
+                existing_rank_log_ids.add(rank_log_id)
+            if inserted_rank_log and star_brawler_id:
+                cur.execute(
+                    "INSERT INTO rank_star_logs(rank_log_id, star_brawler_id, star_player_tag)"
+                    " VALUES (%s, %s, %s) "
+                    "ON DUPLICATE KEY UPDATE "
+                    "star_brawler_id=VALUES(star_brawler_id), "
+                    "star_player_tag=VALUES(star_player_tag)",
+                    (rank_log_id, star_brawler_id, star_player_tag),
+                )
+            new_rank_brawlers_flag = False
+
+        #新規バトル登録
+        battle_log_id = f"{battle_time}_{p_tag}_battle"
+        try:
+            cur.execute(
+                "INSERT INTO battle_logs(id, rank_log_id) VALUES (%s, %s)",
+                (battle_log_id, rank_log_id),
+            )
+            if cur.rowcount > 0:
+                new_battle_logs += cur.rowcount
+        except IntegrityError:
+            logger.debug(
+                "既に記録済みのバトルのためスキップ battle_log_id=%s rank_log_id=%s",
+                battle_log_id,
+                rank_log_id,
+            )
+            continue
+
+        # 組み合わせ前に各陣営を1回だけ検証し、勝者×敗者の直積を作る
+        winners = {
+            (b_id, b_tag)
+            for r in resultInfo
+            if r.result == "victory"
+            for b_id, b_tag in r.brawlers
+            if isinstance(b_id, int) and isinstance(b_tag, str) and b_tag
+        }
+        losers = {
+            (b_id, b_tag)
+            for r in resultInfo
+            if r.result == "defeat"
+            for b_id, b_tag in r.brawlers
+            if isinstance(b_id, int) and isinstance(b_tag, str) and b_tag
+        }
+        win_lose_rows.extend(
+            (w_id, w_tag, l_id, l_tag, battle_log_id)
+            for (w_id, w_tag), (l_id, l_tag) in product(winners, losers)
+        )
+
+    # 勝敗ログは全バトル分をまとめて1文で登録する
+    if win_lose_rows:
+        _insert_win_lose_logs(cur, win_lose_rows)
+
+    if discovered_ranks:
+        # 発見したプレイヤーは既存タグを1回で確認したうえで、複数行 INSERT IGNORE で登録する。
+        # 並列ワーカー間でロックの取得順をそろえてデッドロックを避けるため、タグ順に処理する
+        discovered_tags = sorted(discovered_ranks)
+        placeholders = ",".join(["%s"] * len(discovered_tags))
+        cur.execute(
+            f"SELECT tag FROM players WHERE tag IN ({placeholders})",
+            discovered_tags,
+        )
+        known_tags = {row[0] for row in cur.fetchall()}
+        values = ",".join(["(%s)"] * len(discovered_tags))
+        cur.execute(
+            f"INSERT IGNORE INTO players(tag) VALUES {values}",
+            discovered_tags,
+        )
+        if cur.rowcount > 0:  # 挿入された件数、既存で無視された行は含まない
+            new_players += cur.rowcount
+        for p_tag in discovered_tags:
+            if p_tag in known_tags:
+                continue
+            trophies = discovered_ranks[p_tag][0]
+            if trophies == 22:
+                logger.info("プロランク発見:%s", p_tag)
+            elif trophies > 18:
+                logger.info("マスターランク発見:%s", p_tag)
+            elif trophies > 15:
+                logger.info("レジェンドランク発見:%s", p_tag)
+            elif trophies > 12:
+                logger.info("エピック発見:%s", p_tag)
+
+    if discovered_names:
+        cur.executemany(
+            "UPDATE players SET name=%s WHERE tag=%s AND (name IS NULL OR name='')",
+            [(name, tag) for tag, name in sorted(discovered_names.items())],
+        )
+    if discovered_ranks:
+        cur.executemany(
+            "UPDATE players SET current_rank=%s, highest_rank=GREATEST(highest_rank, %s) WHERE tag=%s",
+            [
+                (current, highest, tag)
+                for tag, (current, highest) in sorted(discovered_ranks.items())
+            ],
+        )
+
+    return (new_players, new_rank_logs, new_battle_logs)
+
+
 def fetch_battle_logs(player_tag: str, api_key: str) -> tuple[int, int, int]:
     """指定したプレイヤーのバトルログを取得してDBへ保存"""
     new_players = 0
     new_rank_logs = 0
     new_battle_logs = 0
-    with get_connection() as conn:
-        cur = conn.cursor()
+    conn = _get_worker_connection()
+    with closing(conn.cursor()) as cur:
         tag_enc = quote(player_tag, safe="")
         url = f"https://api.brawlstars.com/v1/players/{tag_enc}/battlelog"
         headers = {
@@ -356,7 +796,7 @@ def fetch_battle_logs(player_tag: str, api_key: str) -> tuple[int, int, int]:
             return (new_players, new_rank_logs, new_battle_logs)
 
         try:
-            data = resp.json()
+            data = load_json(resp.content)
         except json.JSONDecodeError as e:
             logger.error("JSON の解析に失敗しました: %s", e)
             return (new_players, new_rank_logs, new_battle_logs)
@@ -366,233 +806,34 @@ def fetch_battle_logs(player_tag: str, api_key: str) -> tuple[int, int, int]:
             logger.info("バトルログが見つかりませんでした。")
             return (new_players, new_rank_logs, new_battle_logs)
 
-        cur.execute(
-            "SELECT name, highest_rank, current_rank FROM players WHERE tag=%s",
-            (player_tag,),
-        )
-        row = cur.fetchone()
-        player_name_in_db = (row[0] if row and row[0] else None)
-        player_highest_rank = row[1] if row and row[1] is not None else 0
-        player_current_rank = row[2] if row and row[2] is not None else 0
-
-        (
-            player_name_in_db,
-            player_highest_rank,
-            player_current_rank,
-        ) = _update_player_profile_from_latest_battle(
-            cur,
-            battle_logs,
-            player_tag,
-            player_name_in_db,
-            player_highest_rank,
-            player_current_rank,
-        )
-
-        cur.execute(
-            "UPDATE players SET last_fetched=%s WHERE tag=%s",
-            (datetime.now(JST), player_tag),
-        )
-
-        rank = 0
-        new_rank_flag = False            
-        new_rank_brawlers_flag = False   
-        rank_log_id = None   
-
-        for battle in battle_logs:       
-            battle_detail = battle.get("battle", {})
-            if battle_detail.get("type") not in ["soloRanked"]:
-                continue
-            battle_map_id = battle.get("event", {}).get("id", "不明")
-            battle_mode = battle.get("event", {}).get("mode", "不明")
-            battle_map = battle.get("event", {}).get("map", "不明")
-            battle_time = battle.get("battleTime", "不明")
-            battle_datetime = parse(battle_time).astimezone(JST)
-            col_start_date = datetime.now(JST) - timedelta(days=DATA_RETENTION_DAYS)
-            if battle_datetime < col_start_date:
-                continue
-            star_player = battle_detail.get("starPlayer") or {}
-            star_player_tag = star_player.get("tag")
-            star_brawler_id = (
-                star_player.get("brawler", {}).get("id")
-                if isinstance(star_player.get("brawler"), dict)
-                else None
-            )
-            if star_player_tag:
-                new_rank_flag = True
-                # ランクマッチ(または同一グループ)開始時にランクをリセット
-                rank = 0
-                rank_log_id = f"{battle_time}_{star_player_tag}"
-                # ここですでに存在しているランクマッチを確認
-                cur.execute(
-                    "SELECT id FROM rank_logs WHERE id=%s",
-                    (rank_log_id,),
-                )
-                row = cur.fetchone()
-                if row:
-                    # print(f"既に記録済みのランクマッチ: {rank_log_id}")
-                    new_rank_flag = False
-                    continue
-                else:
-                    new_rank_brawlers_flag = True
-            elif not new_rank_flag:
-                continue
-                
-            result = battle_detail.get("result", "不明")
-            teams = battle_detail.get("teams", [])
-            resultInfo: list[ResultLog] = []
-
-            my_side_idx = None  # 自分がいるチーム(0/1)
-
-            for side_idx,team in enumerate(teams):
-                resultLog = ResultLog()
-                for player in team:
-                    brawler = player.get("brawler") or {}
-                    brawler_id = brawler.get("id")
-                    p_tag = player.get("tag")
-                    resultLog.brawlers.append((brawler_id, p_tag))
-                    player_name = player.get("name")
-                    trophies = player.get("brawler", {}).get("trophies", 0)
-                    if p_tag == player_tag:
-                        my_side_idx = side_idx
-                        resultLog.result = result
-                        # if trophies < 7:
-                        #     cur.execute("DELETE FROM players WHERE tag=%s", (player_tag,))
-                        #     if cur.rowcount == 1:  # 削除されたら1、既に存在しなかったら0
-                        #         logger.info("プレイヤー削除:%s", player_tag)
-                    if p_tag and 16 < trophies <= 22:
-                        cur.execute("INSERT IGNORE INTO players(tag) VALUES (%s)", (p_tag,))
-                        if cur.rowcount == 1:  # 挿入されたら1、既存で無視されたら0
-                            new_players += 1
-                            if trophies == 22:
-                                logger.info("プロランク発見:%s", p_tag)
-                            elif trophies > 18:
-                                logger.info("マスターランク発見:%s", p_tag)
-                            elif trophies > 15:
-                                logger.info("レジェンドランク発見:%s", p_tag)
-                            elif trophies > 12:
-                                logger.info("エピック発見:%s", p_tag)
-                        if player_name:
-                            cur.execute(
-                                "UPDATE players SET name=%s WHERE tag=%s AND (name IS NULL OR name='')",
-                                (player_name, p_tag),
-                            )
-                        if trophies is not None:
-                            cur.execute(
-                                "UPDATE players SET current_rank=%s, highest_rank=GREATEST(highest_rank, %s) WHERE tag=%s",
-                                (trophies, trophies, p_tag),
-                            )
-                    if rank < trophies <= 22:
-                        rank = trophies
-                resultInfo.append(resultLog)
-            if my_side_idx is not None and len(resultInfo) == 2 and result in OPPOSITE:
-                other = 1 - my_side_idx
-                # まだ埋まっていない場合のみ上書き
-                if getattr(resultInfo[other], "result", "不明") in (None, "", "不明"):
-                    resultInfo[other].result = OPPOSITE[result]
-
-            # ランクが低い履歴は登録しない
-            if rank < MIN_REGISTER_RANK:
-                logger.debug(
-                    "ランク%d未満(%d)のため登録スキップ rank_log_id=%s",
-                    MIN_REGISTER_RANK,
-                    rank,
-                    rank_log_id,
-                )
-                new_rank_flag = False
-                new_rank_brawlers_flag = False
-                rank_log_id = None
-                continue
-
-            if new_rank_brawlers_flag:
-                map_id = MAP_NAME_TO_ID.get(battle_map)
-                rank_id = RANK_TO_ID.get(rank)
-                rank_log_id = f"{battle_time}_{star_player_tag}"
-                #新規ランクマッチ登録
-                inserted_rank_log = False
-                try:
-                    cur.execute(
-                        "INSERT INTO rank_logs(id, map_id, rank_id) VALUES (%s, %s, %s)",
-                        (rank_log_id, map_id, rank_id),
-                    )
-                    if cur.rowcount > 0:
-                        new_rank_logs += cur.rowcount
-                        inserted_rank_log = True
-                except IntegrityError as e:
-                    if e.errno == errorcode.ER_DUP_ENTRY:  # 1062: Duplicate entry
-                        logger.info("重複レコードなのでスキップ")
-                        new_rank_flag = False
-                        new_rank_brawlers_flag = False
-                        continue
-                    logger.warning(
-                        "未登録のマップを検出: マップ=%s マップID=%s ランク=%s",
-                        battle_map,
-                        battle_map_id,
-                        rank,
-                    )
-                    logger.warning("Battle detail: %s error: %s", battle, e)
-                    mode_id = cur.execute("SELECT id FROM _modes WHERE name=%s", (battle_mode,)).fetchone()[0]
-                    cur.execute(
-                        "REPLACE INTO _maps(id, name, mode_id) VALUES (%s, %s, %s)",
-                        (battle_map_id, battle_map, mode_id),
-                    )
-                    MAP_NAME_TO_ID[battle_map] = battle_map_id
-                    cur.execute(
-                        "INSERT INTO rank_logs(id, map_id, rank_id) VALUES (%s, %s, %s)",
-                        (rank_log_id, map_id, rank_id),
-                    )
-                    if cur.rowcount > 0:
-                        new_rank_logs += cur.rowcount
-                        inserted_rank_log = True
-                if inserted_rank_log and star_brawler_id:
-                    cur.execute(
-                        "INSERT INTO rank_star_logs(rank_log_id, star_brawler_id, star_player_tag)"
-                        " VALUES (%s, %s, %s) "
-                        "ON DUPLICATE KEY UPDATE "
-                        "star_brawler_id=VALUES(star_brawler_id), "
-                        "star_player_tag=VALUES(star_player_tag)",
-                        (rank_log_id, star_brawler_id, star_player_tag),
-                    )
-                new_rank_brawlers_flag = False
-
-            #新規バトル登録
-            battle_log_id = f"{battle_time}_{p_tag}_battle"
+        # 1プレイヤー分の書き込みを1トランザクションにまとめ、コミットを1回にする。
+        # 対戦相手を共有する他ワーカーとのデッドロック・ロック待ちタイムアウトは
+        # ロールバックして再試行し、解消しなければこのプレイヤーだけスキップする
+        # （last_fetched は更新されないため次回の取得対象に残る）
+        for attempt in range(1, STORE_MAX_RETRIES + 1):
+            conn.start_transaction()
             try:
-                cur.execute(
-                    "INSERT INTO battle_logs(id, rank_log_id) VALUES (%s, %s)",
-                    (battle_log_id, rank_log_id),
-                )
-                if cur.rowcount > 0:
-                    new_battle_logs += cur.rowcount
-            except IntegrityError:
-                logger.debug(
-                    "既に記録済みのバトルのためスキップ battle_log_id=%s rank_log_id=%s",
-                    battle_log_id,
-                    rank_log_id,
+                result = _store_battle_logs(cur, player_tag, battle_logs)
+            except mysql.connector.Error as e:
+                conn.rollback()
+                if e.errno not in LOCK_RETRY_ERRNOS:
+                    raise
+                logger.warning(
+                    "ロック競合のためバトルログ登録をやり直します tag=%s (attempt %d/%d): %s",
+                    player_tag,
+                    attempt,
+                    STORE_MAX_RETRIES,
+                    e,
                 )
                 continue
-
-            winners = [b for r in resultInfo if r.result == "victory" for b in r.brawlers]
-            losers = [b for r in resultInfo if r.result == "defeat" for b in r.brawlers]
-            pairs = {
-                (w_id, w_tag, l_id, l_tag, battle_log_id)
-                for w_id, w_tag in winners
-                for l_id, l_tag in losers
-                if isinstance(w_id, int)
-                and isinstance(l_id, int)
-                and isinstance(w_tag, str)
-                and isinstance(l_tag, str)
-                and w_tag
-                and l_tag
-            }
-            if pairs:
-                cur.executemany(
-                    "INSERT IGNORE INTO win_lose_logs(win_brawler_id, win_player_tag, lose_brawler_id, lose_player_tag, battle_log_id) VALUES (%s, %s, %s, %s, %s)",
-                    list(pairs),
-                )
-
-        conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            conn.commit()
+            return result
+        logger.error("ロック競合が解消しないためスキップします tag=%s", player_tag)
         return (new_players, new_rank_logs, new_battle_logs)
-            
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -643,7 +884,7 @@ def main(args: Optional[argparse.Namespace] = None) -> None:
             new_battle_logs_total = 0
 
             # new_players_total += fetch_rank_player(api_key, conn)
-            rest = 0
+            fetched_players = 0
 
             last_fetch_threshold = datetime.now(JST) - timedelta(hours=args.acq_cycle_hours)
             filter_clause, filter_params = _build_player_filter_clause(
@@ -657,60 +898,80 @@ def main(args: Optional[argparse.Namespace] = None) -> None:
                 )
             logger.info("対象の再取得間隔（時間）: %s", args.acq_cycle_hours)
 
+            # ワーカースレッド（とスレッドごとのDB接続）はバッチ間で使い回す
+            executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
             try:
+                # 取得に失敗して last_fetched が更新されなかったプレイヤーは、
+                # 同じ実行中に何度も選び直されないよう以降の対象から除外する
+                failed_tags: set[str] = set()
                 while 1:
+                    exclude_clause = ""
+                    exclude_params: list[str] = []
+                    if failed_tags:
+                        exclude_clause = " AND tag NOT IN ({})".format(
+                            ",".join(["%s"] * len(failed_tags))
+                        )
+                        exclude_params = sorted(failed_tags)
                     cur = conn.cursor()
                     cur.execute(
                         """
                         SELECT tag FROM players
                         WHERE last_fetched < %s
-                        {filter_clause}
+                        {filter_clause}{exclude_clause}
                         ORDER BY is_monitored DESC, last_fetched ASC
                         LIMIT %s
-                        """.format(filter_clause=filter_clause),
-                        tuple([last_fetch_threshold, *filter_params, FETCH_BATCH_SIZE]),
+                        """.format(filter_clause=filter_clause, exclude_clause=exclude_clause),
+                        tuple([last_fetch_threshold, *filter_params, *exclude_params, FETCH_BATCH_SIZE]),
                     )
                     rows = cur.fetchall()
                     tags = [r[0] for r in rows]
 
                     if not tags:
-                        logger.info("対象プレイヤーがいません")
+                        if fetched_players:
+                            logger.info("全てのプレイヤーを集計しました")
+                        else:
+                            logger.info("対象プレイヤーがいません")
                         break
 
-                    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                        results = executor.map(lambda t: fetch_battle_logs(t, api_key), tags)
-                        for players_added, rank_added, battles_added in results:
-                            new_players_total += players_added
-                            new_rank_logs_total += rank_added
-                            new_battle_logs_total += battles_added
+                    results = executor.map(lambda t: fetch_battle_logs(t, api_key), tags)
+                    for players_added, rank_added, battles_added in results:
+                        new_players_total += players_added
+                        new_rank_logs_total += rank_added
+                        new_battle_logs_total += battles_added
 
                     cur.execute(
-                        """
-                        SELECT COUNT(*) FROM players
-                        WHERE last_fetched < %s
-                        {filter_clause}
-                        """.format(filter_clause=filter_clause),
-                        tuple([last_fetch_threshold, *filter_params]),
+                        "SELECT tag FROM players WHERE last_fetched < %s AND tag IN ({})".format(
+                            ",".join(["%s"] * len(tags))
+                        ),
+                        tuple([last_fetch_threshold, *tags]),
                     )
-                    rest = cur.fetchone()[0]
-                    if rest == 0:
-                        logger.info("全てのプレイヤーを集計しました")
-                        break
-                    logger.info("残り集計対象プレイヤー数:%d", rest)
+                    newly_failed = {r[0] for r in cur.fetchall()}
+                    if newly_failed:
+                        logger.warning(
+                            "取得に失敗したプレイヤーを今回の実行対象から除外します: %s",
+                            ", ".join(sorted(newly_failed)),
+                        )
+                        failed_tags |= newly_failed
+                    fetched_players += len(tags) - len(newly_failed)
+                    logger.info("集計済みプレイヤー数:%d", fetched_players)
 
             finally:
+                # 例外や中断で抜けた場合、未着手の取得タスクは実行せずに破棄する
+                executor.shutdown(wait=True, cancel_futures=True)
+                _close_worker_connections()
                 cur = conn.cursor()
-                cur.execute("SELECT COUNT(*) FROM players")
-                players = cur.fetchone()[0]
-                logger.info("集計プレイヤー:%d", players - rest)
+                cur.execute(
+                    """
+                    SELECT
+                        (SELECT COUNT(*) FROM players),
+                        (SELECT COUNT(*) FROM rank_logs),
+                        (SELECT COUNT(*) FROM battle_logs)
+                    """
+                )
+                players, rank_logs, battles = cur.fetchone()
+                logger.info("集計プレイヤー:%d", fetched_players)
                 logger.info("プレイヤー総数:%d", players)
-
-                cur.execute("SELECT COUNT(*) FROM rank_logs")
-                rank_logs = cur.fetchone()[0]
                 logger.info("集計済みランクマッチ:%d", rank_logs)
-
-                cur.execute("SELECT COUNT(*) FROM battle_logs")
-                battles = cur.fetchone()[0]
                 logger.info("集計済みバトル:%d", battles)
 
                 total_time = time.time() - start_time
@@ -0,0 +1,49 @@
+"""JSON のデコード・エンコードを共通化するユーティリティ.
+
+``orjson`` が導入されていれば高速な実装を利用し、無い環境では標準ライブラリの
+``json`` にフォールバックする。
+"""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any, Final
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson 未導入環境
+    orjson = None  # type: ignore[assignment]
+
+__all__: Final = ("loads", "write_json")
+
+if orjson is not None:
+    # 標準ライブラリの json.dump(indent=2) と同じ見た目で出力するためのオプション
+    ORJSON_WRITE_OPTIONS: Final = (
+        orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    )
+
+
+def loads(data: bytes | str) -> Any:
+    """JSON のバイト列または文字列をデコードする.
+
+    ``orjson.JSONDecodeError`` は ``json.JSONDecodeError`` のサブクラスのため、
+    呼び出し側は実装に関わらず ``json.JSONDecodeError`` を捕捉すればよい。
+    """
+
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def write_json(path: Path, data: Any) -> None:
+    """データを UTF-8・インデント2の JSON としてファイルへ書き出す.
+
+    エンコード結果をまとめて1回で書き込む。``orjson`` 利用時は辞書の整数キーも
+    標準ライブラリと同様に文字列キーとして出力し、NumPy のスカラー値もそのまま扱う。
+    """
+
+    if orjson is not None:
+        path.write_bytes(orjson.dumps(data, option=ORJSON_WRITE_OPTIONS))
+        return
+    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
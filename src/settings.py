@@ -5,6 +5,7 @@ from __future__ import annotations
 import os
 from functools import lru_cache
 from pathlib import Path
+from typing import Optional
 
 from dotenv import load_dotenv
 
@@ -51,6 +52,19 @@ def _get_float_env(name: str, default: float) -> float:
         ) from exc
 
 
+def _get_optional_path_env(name: str) -> Optional[Path]:
+    """環境変数をパスとして取得する。未設定の場合は None を返す。"""
+    load_environment()
+    value = os.getenv(name)
+    if value in (None, ""):
+        return None
+    path = Path(value).expanduser()
+    if not path.is_absolute():
+        path = BASE_DIR / path
+    return path
+
+
 DATA_RETENTION_DAYS = _get_int_env("DATA_RETENTION_DAYS", _DEFAULT_RETENTION_DAYS)
 MIN_RANK_ID = _get_int_env("MIN_RANK_ID", _DEFAULT_MIN_RANK_ID)
 CONFIDENCE_LEVEL = _get_float_env("CONFIDENCE_LEVEL", _DEFAULT_CONFIDENCE_LEVEL)
+STATS_CACHE_DIR = _get_optional_path_env("STATS_CACHE_DIR")
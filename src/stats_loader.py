@@ -2,12 +2,18 @@
 
 from __future__ import annotations
 
+import hashlib
 import logging
+import os
+import pickle
 from collections import defaultdict
 from dataclasses import dataclass, field
+from pathlib import Path
 from time import perf_counter
 from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 
+import numpy as np
+
 from .memory_utils import log_memory_usage
 from .settings import MIN_RANK_ID
 
@@ -15,6 +21,9 @@ logger = logging.getLogger(__name__)
 
 
 FETCH_BATCH_SIZE = 100_000
+DATASET_CACHE_PREFIX = "ranked_battles_"
+# StatsDataset などキャッシュに保存するクラスの構造を変えたら値を上げる
+DATASET_CACHE_VERSION = 1
 
 
 def _parse_team_members(member_ids: Optional[str]) -> Tuple[int, ...]:
@@ -69,6 +78,9 @@ class StatsDataset:
     _participants_cache: Optional[Dict[str, Set[int]]] = field(
         default=None, init=False, repr=False
     )
+    _participant_arrays_cache: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = field(
+        default=None, init=False, repr=False
+    )
 
     def iter_ranked_battles(self) -> Iterable[RankedBattle]:
         """読みやすい名前のイテレータを提供."""
@@ -88,6 +100,52 @@ class StatsDataset:
             self._participants_cache = {k: set(v) for k, v in participants.items()}
         return self._participants_cache
 
+    def participant_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """バトル参加キャラクターを (map_id, brawler_id, is_win) の平坦な配列で取得する.
+
+        集計処理を NumPy のベクトル演算で行えるよう、1バトル1キャラクターを1要素とした
+        配列に展開する。
+        """
+
+        if self._participant_arrays_cache is None:
+            map_ids: List[int] = []
+            brawler_ids: List[int] = []
+            results: List[bool] = []
+            for battle in self.battles:
+                for brawlers, is_win in (
+                    (battle.win_brawlers, True),
+                    (battle.lose_brawlers, False),
+                ):
+                    if not brawlers:
+                        continue
+                    map_ids.extend([battle.map_id] * len(brawlers))
+                    brawler_ids.extend(brawlers)
+                    results.extend([is_win] * len(brawlers))
+            self._participant_arrays_cache = (
+                np.asarray(map_ids, dtype=np.int64),
+                np.asarray(brawler_ids, dtype=np.int64),
+                np.asarray(results, dtype=bool),
+            )
+        return self._participant_arrays_cache
+
+    def trio_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """勝敗両陣営が3人ずつ揃ったバトルを (map_id, 勝者ID[N,3], 敗者ID[N,3]) の配列で取得する."""
+
+        map_ids: List[int] = []
+        win_ids: List[Tuple[int, ...]] = []
+        lose_ids: List[Tuple[int, ...]] = []
+        for battle in self.battles:
+            if len(battle.win_brawlers) != 3 or len(battle.lose_brawlers) != 3:
+                continue
+            map_ids.append(battle.map_id)
+            win_ids.append(battle.win_brawlers)
+            lose_ids.append(battle.lose_brawlers)
+        return (
+            np.asarray(map_ids, dtype=np.int64),
+            np.asarray(win_ids, dtype=np.int64).reshape(-1, 3),
+            np.asarray(lose_ids, dtype=np.int64).reshape(-1, 3),
+        )
+
 
 def load_recent_ranked_battles(conn, since: str) -> StatsDataset:
     """直近期間のランクマッチ関連データをまとめて読み込む."""
@@ -302,3 +360,76 @@ def load_recent_ranked_battles(conn, since: str) -> StatsDataset:
     )
     return dataset
 
+
+def _dataset_fingerprint(conn, since: str) -> str:
+    """読み込み対象のランクログ件数と最新IDからデータセットの指紋を求める.
+
+    バトルログと勝敗ログはランクログと同一トランザクションで登録・削除されるため、
+    対象範囲のランクログ件数と最大IDが変わらなければ読み込み結果も変わらない。
+    クラス構造の異なる古い pickle を読み込まないよう、キャッシュ形式のバージョンも含める。
+    """
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """
+            SELECT COUNT(*), MAX(rl.id)
+            FROM rank_logs rl
+            WHERE rl.rank_id >= %s AND rl.id >= %s
+            """,
+            (MIN_RANK_ID, since),
+        )
+        count, max_id = cursor.fetchone()
+    finally:
+        cursor.close()
+    source = f"v{DATASET_CACHE_VERSION}:{since}:{MIN_RANK_ID}:{count}:{max_id}"
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+
+def load_recent_ranked_battles_cached(
+    conn, since: str, cache_dir: Optional[Path]
+) -> StatsDataset:
+    """指紋が一致するキャッシュがあれば再利用し、なければDBから読み込んで保存する."""
+
+    if cache_dir is None:
+        return load_recent_ranked_battles(conn, since)
+
+    cache_path = cache_dir / f"{DATASET_CACHE_PREFIX}{_dataset_fingerprint(conn, since)}.pkl"
+    if cache_path.exists():
+        load_start = perf_counter()
+        try:
+            with open(cache_path, "rb") as fp:
+                dataset = pickle.load(fp)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as exc:
+            logger.warning("データセットのキャッシュを読み込めませんでした: %s (%s)", cache_path, exc)
+        else:
+            logger.info(
+                "データセットのキャッシュを使用します: %s (%.2f秒)",
+                cache_path,
+                perf_counter() - load_start,
+            )
+            return dataset
+
+    dataset = load_recent_ranked_battles(conn, since)
+
+    # 同時に動く別プロセスと一時ファイルを共有しないよう、PID を付けた名前で書き出す
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, "wb") as fp:
+            pickle.dump(dataset, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path.replace(cache_path)
+        # 指紋が変わった古いキャッシュは再利用されないため削除する
+        for stale in cache_dir.glob(f"{DATASET_CACHE_PREFIX}*.pkl"):
+            if stale != cache_path:
+                stale.unlink(missing_ok=True)
+    except (OSError, pickle.PicklingError) as exc:
+        # キャッシュは任意機能のため、保存に失敗しても読み込んだデータで処理を続ける
+        logger.warning("データセットのキャッシュを保存できませんでした: %s (%s)", cache_path, exc)
+        try:
+            tmp_path.unlink(missing_ok=True)
+        except OSError:
+            pass
+    else:
+        logger.info("データセットのキャッシュを保存しました: %s", cache_path)
+    return dataset
@@ -2,23 +2,17 @@
 from __future__ import annotations
 
 from collections import defaultdict
+from itertools import chain, combinations
 import math
-from typing import Dict, Iterable, List, Optional, Tuple
-
-from scipy.stats import beta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
+from .beta_stats import beta_lcb
 from .settings import CONFIDENCE_LEVEL, MIN_RANK_ID
-from .stats_loader import StatsDataset
+from .stats_loader import StatsDataset, _iter_cursor
 
 TrioRow = Tuple[int, int, int, int, int, int, float, float]
-MIN_BETA_SHAPE = 1e-6
-
-
-def beta_lcb(alpha: float, beta_param: float, confidence: float = CONFIDENCE_LEVEL) -> float:
-    """Beta分布に基づく下側信頼限界を計算する."""
-    alpha_safe = max(alpha, MIN_BETA_SHAPE)
-    beta_safe = max(beta_param, MIN_BETA_SHAPE)
-    return float(beta.ppf(1 - confidence, alpha_safe, beta_safe))
+# 勝敗ログを読み出す際の1回あたりの取得件数
+FETCH_BATCH_SIZE = 50_000
 
 
 def fetch_trio_rows(
@@ -50,11 +44,13 @@ def fetch_trio_rows(
     conditions: List[str] = []
     params: List[object] = [MIN_RANK_ID]
 
+    # rank_logs.id は日付8桁で始まるため、SUBSTRING を使わずに直接比較して
+    # 主キーの範囲検索を効かせる
     if since is not None:
-        conditions.append("SUBSTRING(rl.id,1,8) >= %s")
+        conditions.append("rl.id >= %s")
         params.append(since)
     if until is not None:
-        conditions.append("SUBSTRING(rl.id,1,8) < %s")
+        conditions.append("rl.id < %s")
         params.append(until)
     if rank_id is not None:
         conditions.append("rl.rank_id = %s")
@@ -70,89 +66,48 @@ def fetch_trio_rows(
     if conditions:
         condition_sql = " AND " + " AND ".join(conditions)
 
+    # トリオの組み合わせを SQL の自己結合で展開すると k^3 の中間結果が発生するため、
+    # 勝敗ログをそのまま読み出し、バトルごとの編成を Python 側で組み立てる
     sql = f"""
-        WITH recent_battles AS (
-            SELECT bl.id AS battle_log_id,
-                   rl.map_id,
-                   rl.rank_id,
-                   m.mode_id
-            FROM battle_logs bl
-            JOIN rank_logs rl ON bl.rank_log_id = rl.id
-            JOIN _maps m ON rl.map_id = m.id
-            WHERE rl.rank_id >= %s{condition_sql}
-        ),
-        win_brawlers AS (
-            SELECT DISTINCT wl.battle_log_id, wl.win_brawler_id AS brawler_id
-            FROM win_lose_logs wl
-            JOIN recent_battles rb ON wl.battle_log_id = rb.battle_log_id
-        ),
-        lose_brawlers AS (
-            SELECT DISTINCT wl.battle_log_id, wl.lose_brawler_id AS brawler_id
-            FROM win_lose_logs wl
-            JOIN recent_battles rb ON wl.battle_log_id = rb.battle_log_id
-        ),
-        win_trios AS (
-            SELECT rb.map_id,
-                   rb.rank_id,
-                   rb.mode_id,
-                   wb1.brawler_id AS brawler_a,
-                   wb2.brawler_id AS brawler_b,
-                   wb3.brawler_id AS brawler_c
-            FROM win_brawlers wb1
-            JOIN win_brawlers wb2
-                ON wb1.battle_log_id = wb2.battle_log_id
-               AND wb1.brawler_id < wb2.brawler_id
-            JOIN win_brawlers wb3
-                ON wb1.battle_log_id = wb3.battle_log_id
-               AND wb2.brawler_id < wb3.brawler_id
-            JOIN recent_battles rb ON wb1.battle_log_id = rb.battle_log_id
-        ),
-        lose_trios AS (
-            SELECT rb.map_id,
-                   rb.rank_id,
-                   rb.mode_id,
-                   lb1.brawler_id AS brawler_a,
-                   lb2.brawler_id AS brawler_b,
-                   lb3.brawler_id AS brawler_c
-            FROM lose_brawlers lb1
-            JOIN lose_brawlers lb2
-                ON lb1.battle_log_id = lb2.battle_log_id
-               AND lb1.brawler_id < lb2.brawler_id
-            JOIN lose_brawlers lb3
-                ON lb1.battle_log_id = lb3.battle_log_id
-               AND lb2.brawler_id < lb3.brawler_id
-            JOIN recent_battles rb ON lb1.battle_log_id = rb.battle_log_id
-        ),
-        win_counts AS (
-            SELECT map_id, rank_id, mode_id, brawler_a, brawler_b, brawler_c, COUNT(*) AS wins
-            FROM win_trios
-            GROUP BY map_id, rank_id, mode_id, brawler_a, brawler_b, brawler_c
-        ),
-        lose_counts AS (
-            SELECT map_id, rank_id, mode_id, brawler_a, brawler_b, brawler_c, COUNT(*) AS losses
-            FROM lose_trios
-            GROUP BY map_id, rank_id, mode_id, brawler_a, brawler_b, brawler_c
-        ),
-        combined AS (
-            SELECT map_id, rank_id, mode_id, brawler_a, brawler_b, brawler_c, wins, 0 AS losses FROM win_counts
-            UNION ALL
-            SELECT map_id, rank_id, mode_id, brawler_a, brawler_b, brawler_c, 0 AS wins, losses FROM lose_counts
-        )
-        SELECT map_id,
-               rank_id,
-               mode_id,
-               brawler_a,
-               brawler_b,
-               brawler_c,
-               SUM(wins) AS wins,
-               SUM(losses) AS losses
-        FROM combined
-        GROUP BY map_id, rank_id, mode_id, brawler_a, brawler_b, brawler_c
+        SELECT bl.id,
+               rl.map_id,
+               rl.rank_id,
+               m.mode_id,
+               wl.win_brawler_id,
+               wl.lose_brawler_id
+        FROM battle_logs bl
+        JOIN rank_logs rl ON bl.rank_log_id = rl.id
+        JOIN _maps m ON rl.map_id = m.id
+        JOIN win_lose_logs wl ON wl.battle_log_id = bl.id
+        WHERE rl.rank_id >= %s{condition_sql}
     """
 
     cur.execute(sql, tuple(params))
-    rows: List[TrioRow] = cur.fetchall()
+    battles: Dict[str, Tuple[int, int, Optional[int], Set[int], Set[int]]] = {}
+    for battle_log_id, map_key, rank_key, mode_key, win_id, lose_id in chain.from_iterable(
+        _iter_cursor(cur, FETCH_BATCH_SIZE)
+    ):
+        entry = battles.get(battle_log_id)
+        if entry is None:
+            entry = (map_key, rank_key, mode_key, set(), set())
+            battles[battle_log_id] = entry
+        entry[3].add(win_id)
+        entry[4].add(lose_id)
     cur.close()
+
+    stats: Dict[Tuple[int, int, Optional[int], Tuple[int, int, int]], List[int]] = defaultdict(
+        lambda: [0, 0]
+    )
+    for map_key, rank_key, mode_key, win_ids, lose_ids in battles.values():
+        for trio in combinations(sorted(win_ids), 3):
+            stats[(map_key, rank_key, mode_key, trio)][0] += 1
+        for trio in combinations(sorted(lose_ids), 3):
+            stats[(map_key, rank_key, mode_key, trio)][1] += 1
+
+    rows: List[TrioRow] = [
+        (map_key, rank_key, mode_key, b1, b2, b3, float(wins), float(losses))
+        for (map_key, rank_key, mode_key, (b1, b2, b3)), (wins, losses) in stats.items()
+    ]
     return rows
 
 